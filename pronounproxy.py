@@ -1,15 +1,13 @@
-import asyncio, re
-from os import getpid
+import asyncio, os, re, signal, socket, sys
 import s5
 
 """
 Pronoun Proxy: A simple SOCKS5 proxy server that changes gendered pronouns to those of another gender. Listens on port 1080.
+On Linux, runs one worker process per CPU, each listening on the port, and lets the kernel spread connections between them.
 
 Current limitations / bugs:
-* Assumes the stream we're proxying uses a line-based protocol (which seems reasonable given that we're manipulating English text)
-* Ctrl-C is not properly handled if there is an open connection -- server must be killed manually by PID
+* Ctrl-C is not properly handled if there is an open connection -- server must be killed manually by PID (that of the first "Server listening" line, which stops the other workers too)
 * Currently supports only CONNECT requests (and not BIND or UDP ASSOCIATE)
-* Connection to client is not always closed immediately when the connection to the destination closes
 """
 
 
@@ -21,19 +19,30 @@ pronoun_map = {
 	b"her": b"him",
 	b"hers": b"his",
 } 
-# We also want to change them if they're uppercase or title case
+# We also want to change them if they're uppercase or title case.
+# These are spelled out rather than using re.IGNORECASE: that would also match mixed case like "hE",
+# and matching case-insensitively (then restoring the case of the replacement) benchmarks slower anyway.
 pronoun_map.update(
 	[(a.upper(), b.upper()) for a,b in pronoun_map.items()] + 
 	[(a.title(), b.title()) for a,b in pronoun_map.items()]
 )
 # Make a regex that looks like "\b(he|him|...)\b"
-pronoun_regex = b"\\b(" + b"|".join(pronoun_map.keys()) + b")\\b"
-def swap_pronouns(line):
-	return re.sub(
-		pronoun_regex,
-		lambda match : pronoun_map.get(match.group(0), match.group(0)),
-		line
-	)
+# Compiled once here rather than handing the raw pattern to re.sub on every call
+pronoun_regex = re.compile(b"\\b(" + b"|".join(pronoun_map.keys()) + b")\\b")
+def swap_pronouns(data, _split=pronoun_regex.split, _lookup=pronoun_map.__getitem__):
+	# Since the regex has a capturing group, split() leaves the matched pronouns at the odd indices.
+	# Every match comes from the alternation above, so it's always a key -- no need for .get() with a fallback
+	# (The default arguments just save attribute lookups on every call.)
+	parts = _split(data)
+	if len(parts) == 1:
+		return data # No pronouns (the common case), so skip building a copy
+	parts[1::2] = map(_lookup, parts[1::2])
+	return b"".join(parts)
+
+# Bytes that count as part of a word for \b (i.e., what \w matches in a bytes regex)
+word_bytes = bytes(c for c in range(128) if chr(c).isalnum() or chr(c) == "_")
+longest_pronoun = max(map(len, pronoun_map))
+read_size = 65536
 
 async def handle_socks_client(client_reader, client_writer):
 	"""
@@ -49,33 +58,119 @@ async def handle_socks_client(client_reader, client_writer):
 		dest_reader, dest_writer = reader_writer_pair
 		try:
 			print("Proxying data")	
-			await asyncio.gather(
-				copy_stream(client_reader, dest_writer),
-				copy_stream(dest_reader, client_writer, line_filter=swap_pronouns)
-			)
+			to_dest = asyncio.ensure_future(copy_stream(client_reader, dest_writer))
+			to_client = asyncio.ensure_future(copy_stream(dest_reader, client_writer, data_filter=swap_pronouns))
+			try:
+				done, pending = await asyncio.wait({to_dest, to_client}, return_when=asyncio.FIRST_COMPLETED)
+				# If the client just finished sending, copy_stream has passed the EOF along and the destination may still have plenty to say,
+				# so keep going until it's done too. But if the client's side failed (e.g. it reset the connection), or the destination is done
+				# and there's no one left for the client to talk to, tear both sides down now.
+				if to_client not in done and to_dest.exception() is None:
+					await asyncio.wait({to_client})
+			finally:
+				to_dest.cancel()
+				to_client.cancel()
+				for result in await asyncio.gather(to_dest, to_client, return_exceptions=True):
+					# Before Python 3.8 CancelledError is an Exception, but it just means we stopped that direction ourselves
+					if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+						print("Error while proxying: %r" % result)
 		finally:
 			dest_writer.close()
 	finally:
 		client_writer.close()
 
-async def copy_stream(reader, writer, line_filter=(lambda x: x)):
-	"""Copy every line the reader reads to the writer (after passing it through line_filter)"""
-	"""As a simplifying assumption I'm assuming that whatever protocol we're proxying is line based, which seems reasonable given that we're working with english text."""
+async def copy_stream(reader, writer, data_filter=None):
+	"""Copy everything the reader reads to the writer (after passing it through data_filter, if given)"""
+	"""
+	Data is filtered in whole chunks as it arrives rather than a line at a time, so we only wait on the reader once per chunk.
+	A word that's cut off at the end of a chunk is held back until we see the rest of it, so data_filter never sees half a word.
+	We wait for the writer to drain after each chunk so a slow receiver can't make us buffer without limit. The reader's
+	transport keeps reading from its socket into the StreamReader's buffer in the meantime, so reads still overlap with writes.
+	"""
+	read, write, drain = reader.read, writer.write, writer.drain
+	if data_filter is None:
+		# Nothing to change, so hand each chunk to the transport exactly as we got it -- no holding back, no copies
+		while True:
+			data = await read(read_size)
+			if not data:
+				writer.write_eof()
+				break
+			write(data)
+			await drain()
+		return
+	carry = b""
 	while True:
-		line = await reader.readline()
-		if not line:
+		data = await read(read_size)
+		if not data:
+			if carry:
+				write(data_filter(carry))
 			writer.write_eof()
 			break
-		writer.write(line_filter(line))
+		data = carry + data
+		head = data.rstrip(word_bytes)
+		tail = data[len(head):]
+		if len(tail) > longest_pronoun:
+			# This word is already too long to be a pronoun, so it can go out as is.
+			# Keep just enough of it back that the rest of the word still doesn't look like a pronoun next time around.
+			carry = tail[-(longest_pronoun + 1):]
+			write(data_filter(head) + tail[:-(longest_pronoun + 1)])
+		else:
+			carry = tail
+			if head:
+				write(data_filter(head))
+		await drain()
 
 if __name__ == "__main__":
+	try:
+		import uvloop
+		asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+	except ImportError:
+		pass # uvloop is optional; the standard asyncio event loop works fine, just slower
+
+	# Only Linux spreads incoming TCP connections across SO_REUSEPORT listeners; elsewhere extra workers would mostly sit idle.
+	# Bind all the listening sockets up front so that if we can't bind (e.g. some other program holds the port) we find out before forking.
+	# Note that this doesn't catch another copy of this proxy: since it sets SO_REUSEPORT too, the two would quietly share the port.
+	workers = (os.cpu_count() or 1) if sys.platform.startswith("linux") else 1
+	listeners = []
+	for _ in range(workers):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		if os.name == "posix":
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Same as asyncio.start_server does, so we can restart right away
+		if workers > 1:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		sock.bind(('127.0.0.1', 1080))
+		sock.listen()
+		listeners.append(sock)
+	# The original process keeps the first socket; each forked worker keeps one of the others
+	my_sock = listeners[0]
+	worker_pids = []
+	for sock in listeners[1:]:
+		pid = os.fork()
+		if pid == 0:
+			my_sock = sock
+			worker_pids = [] # The workers' PIDs are only the original process's business
+			break
+		worker_pids.append(pid)
+	for sock in listeners:
+		if sock is not my_sock:
+			sock.close()
+
 	loop = asyncio.get_event_loop()
 	loop.set_debug(True)
-	server = loop.run_until_complete(asyncio.start_server(handle_socks_client, '127.0.0.1', 1080, loop=loop))
-	print("Server listening on port 1080. (pid %d)" % getpid())
+	server = loop.run_until_complete(asyncio.start_server(handle_socks_client, sock=my_sock))
+	print("Server listening on port 1080. (pid %d)" % os.getpid())
+	if worker_pids:
+		# Let the original process be stopped with a plain kill, and take the workers down with it
+		loop.add_signal_handler(signal.SIGTERM, loop.stop)
 	try:
 		loop.run_forever()
 	except:
 		pass
+	for pid in worker_pids:
+		try:
+			os.kill(pid, signal.SIGTERM)
+		except ProcessLookupError:
+			pass # Already gone (e.g. it got the same Ctrl-C we did)
+		os.waitpid(pid, 0)
 	server.close()
 	loop.close()
@@ -1,26 +1,31 @@
 import asyncio, socket, struct
 
-async def read_pstring(reader):
-	"""Read a Pascal-style string (one-byte length followed by that many bytes) from the stream."""
-	length = ord(await reader.readexactly(1))
-	assert(0 <= length < 256)
-	return await reader.readexactly(length)
+# Ports are sent as 2-byte big-endian integers. Parsing the format string once here saves doing it on every connection.
+port_struct = struct.Struct(">H")
 
-async def read_atyp_addr(reader):
+# Successful replies up to (but not including) BND.PORT, keyed by our IP address.
+# We only ever connect out from a handful of local addresses, so after the first connection these are always cached.
+success_reply_prefixes = {}
+
+async def read_addr_port(reader, atyp):
 	"""
-	Read an (atyp, addr) pair from the stream.
-	Return the address as a string suitable for passing into asyncio.open_connection() (e.g., "1.2.3.4" or "example.com")
+	Read an (addr, port) pair of address type atyp from the stream. The address and port are read together so that we usually only wait on the stream once.
+	Return the address as a string suitable for passing into asyncio.open_connection() (e.g., "1.2.3.4" or "example.com") and the port as an int
 	Raise ValueError if atyp is an invalid address type
 	"""
-	atyp = ord(await reader.readexactly(1))
 	if atyp == 0x01: # IPv4
-		return socket.inet_ntop(socket.AF_INET, await reader.readexactly(4))
-	elif atyp == 0x03: # Domain name
-		return (await read_pstring(reader)).decode('utf-8')
+		buf = await reader.readexactly(4 + 2)
+		addr = socket.inet_ntop(socket.AF_INET, buf[:4])
+	elif atyp == 0x03: # Domain name, as a Pascal-style string (one-byte length followed by that many bytes)
+		length = ord(await reader.readexactly(1))
+		buf = await reader.readexactly(length + 2)
+		addr = buf[:length].decode('utf-8')
 	elif atyp == 0x04: # IPv6
-		return socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+		buf = await reader.readexactly(16 + 2)
+		addr = socket.inet_ntop(socket.AF_INET6, buf[:16])
 	else:
 		raise ValueError("Unrecognized ATYP: 0x%02X" % atyp)
+	return addr, port_struct.unpack_from(buf, len(buf) - 2)[0]
 
 async def handle_version_method(reader, writer):
 	"""
@@ -43,17 +48,18 @@ async def handle_version_method(reader, writer):
 
 	(diagrams from RFC 1928)
 	"""
-	version = ord(await reader.readexactly(1))
+	version, nmethods = await reader.readexactly(2)
 	if version != 5:
 		print("Bad version: %d" % version)
 		return False
-	methods = await read_pstring(reader)
+	methods = await reader.readexactly(nmethods)
 	if 0x00 in methods:
-		writer.write(b"\x05\x00") # 0x00 is the "No authentication required" method
-		await writer.drain()
+		# 0x00 is the "No authentication required" method.
+		# No need to drain here: the client can't send its request until it gets this, and handle_connection_request drains after its own reply.
+		writer.write(b"\x05\x00")
 		return True
 	else:
-		writer.write("\x05\xFF") # 0xFF means "No acceptable methods"
+		writer.write(b"\x05\xFF") # 0xFF means "No acceptable methods"
 		await writer.drain()
 		print("No acceptable methods")
 		return False
@@ -80,11 +86,10 @@ async def handle_connection_request(reader, writer):
 	+----+-----+-------+------+----------+----------+
 	(diagrams from RFC 1928)
 	"""
-	version, command, reserved = await reader.readexactly(3)
+	version, command, reserved, atyp = await reader.readexactly(4)
 	if version != 5 or reserved != 0:
 		raise ValueError("Malformed SOCKS request")
-	dst_addr = await read_atyp_addr(reader)
-	dst_port = struct.unpack(">H", await reader.readexactly(2))[0]
+	dst_addr, dst_port = await read_addr_port(reader, atyp)
 
 	if command == 0x01: # CONNECT
 		print("Requested to connect to {}:{}".format(dst_addr, dst_port))
@@ -102,12 +107,14 @@ async def handle_connection_request(reader, writer):
 		# my_addr is (IP, port) for IPv4 and (IP, port, flowinfo, scopeid) for IPv6
 		my_ip = my_addr[0]
 		my_port = my_addr[1]
-		ipv6 = (len(my_addr) == 4)
-		reply = b"\x05\x00\x00" + \
-			(b"\x04" if ipv6 else b"\x01") + \
-			socket.inet_pton(socket.AF_INET6 if ipv6 else socket.AF_INET, my_ip) + \
-			struct.pack(">H", my_port)
-		writer.write(reply)
+		reply_prefix = success_reply_prefixes.get(my_ip)
+		if reply_prefix is None:
+			ipv6 = (len(my_addr) == 4)
+			reply_prefix = b"\x05\x00\x00" + \
+				(b"\x04" if ipv6 else b"\x01") + \
+				socket.inet_pton(socket.AF_INET6 if ipv6 else socket.AF_INET, my_ip)
+			success_reply_prefixes[my_ip] = reply_prefix
+		writer.write(reply_prefix + port_struct.pack(my_port))
 		await writer.drain()
 		return dest_reader, dest_writer
 	else: